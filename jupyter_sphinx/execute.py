@@ -3,14 +3,23 @@
 import os
 from itertools import groupby, count
 from operator import itemgetter
+import hashlib
 import json
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+import threading
+import time
 from ast import literal_eval
+from copy import deepcopy
+from functools import lru_cache, partial
 
 from sphinx.util import logging
 from sphinx.transforms import SphinxTransform
+from sphinx.transforms.post_transforms import SphinxPostTransform
 from sphinx.errors import ExtensionError
 from sphinx.addnodes import download_reference
-from sphinx.ext.mathbase import displaymath
 
 import docutils
 from IPython.lib.lexers import IPythonTracebackLexer, IPython3Lexer
@@ -19,12 +28,17 @@ from docutils.parsers.rst import Directive, directives
 import nbconvert
 from nbconvert.preprocessors.execute import ExecutePreprocessor
 from nbconvert.preprocessors import ExtractOutputPreprocessor
-from nbconvert.writers import FilesWriter
 
+from jupyter_client import KernelManager
 from jupyter_client.kernelspec import get_kernel_spec, NoSuchKernel
 
 import nbformat
+from nbformat.v4 import output_from_msg
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 from ._version import __version__
 
@@ -34,18 +48,33 @@ WIDGET_VIEW_MIMETYPE = 'application/vnd.jupyter.widget-view+json'
 WIDGET_STATE_MIMETYPE = 'application/vnd.jupyter.widget-state+json'
 
 
-def blank_nb(kernel_name):
+# Resolving a kernel spec searches the kernel directories on disk, so
+# specs are cached; the caches are cleared at the start of every build.
+@lru_cache(maxsize=None)
+def kernel_spec(kernel_name):
     try:
-        spec = get_kernel_spec(kernel_name)
+        return get_kernel_spec(kernel_name)
     except NoSuchKernel as e:
-        raise ExtensionError('Unable to find kernel', orig_exc=e)
-    return nbformat.v4.new_notebook(metadata={
+        raise ExtensionError(
+            'Unable to find kernel "{}"'.format(kernel_name), orig_exc=e
+        )
+
+
+@lru_cache(maxsize=None)
+def notebook_metadata(kernel_name):
+    spec = kernel_spec(kernel_name)
+    return {
         'kernelspec': {
             'display_name': spec.display_name,
             'language': spec.language,
             'name': kernel_name,
         }
-    })
+    }
+
+
+def blank_nb(kernel_name):
+    metadata = notebook_metadata(kernel_name)
+    return nbformat.v4.new_notebook(metadata=deepcopy(metadata))
 
 
 def get_widgets(notebook):
@@ -84,6 +113,89 @@ def extract_widget_state(executor):
     return literal_eval(output['data']['text/plain'])
 
 
+# Kernel-side code that records the files opened for reading (using an
+# audit hook, so Python >= 3.8 only), except those of the Python
+# installation, its site-packages and caches. It also provides a function
+# returning them, together with the modification times of the directories
+# on 'sys.path' that belong to the Python installation (which change when
+# packages are installed), as JSON.
+TRACK_INPUTS = '''\
+def _jupyter_sphinx_track_inputs():
+    import json, os, site, sys, sysconfig
+    if not hasattr(sys, '_jupyter_sphinx_opened'):
+        opened = sys._jupyter_sphinx_opened = set()
+
+        def prefixes(paths):
+            return tuple(os.path.join(os.path.abspath(path), '')
+                         for path in paths)
+
+        installation = {
+            sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix,
+        }
+        installation.update(
+            sysconfig.get_paths()[name]
+            for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+        )
+        if hasattr(site, 'getsitepackages'):
+            installation.update(site.getsitepackages())
+        installation.add(site.getusersitepackages())
+        installation = prefixes(installation)
+        # Not the temporary directory, where projects are often built
+        ignored = installation + prefixes([
+            os.path.expanduser('~/.cache'), '/dev', '/proc', '/sys',
+        ])
+
+        def hook(event, args):
+            if event != 'open' or not isinstance(args[0], str):
+                return
+            path, mode, flags = args
+            if mode is None:
+                reading = flags & os.O_ACCMODE != os.O_WRONLY
+            else:
+                reading = 'r' in mode or '+' in mode
+            path = os.path.abspath(path)
+            if reading and not path.startswith(ignored):
+                opened.add(path)
+
+        def inputs():
+            # Other directories, like the working directory, change
+            # whenever any file in them is created or removed
+            paths = {
+                path: os.stat(path).st_mtime
+                for path in sys.path
+                if os.path.isdir(path)
+                and prefixes([path])[0].startswith(installation)
+            }
+            return json.dumps({'files': sorted(opened), 'paths': paths})
+
+        sys._jupyter_sphinx_inputs = inputs
+        if hasattr(sys, 'addaudithook'):
+            sys.addaudithook(hook)
+    sys._jupyter_sphinx_opened.clear()
+_jupyter_sphinx_track_inputs()
+del _jupyter_sphinx_track_inputs
+'''
+
+
+def track_inputs(executor):
+    """Start recording the execution inputs in a running Python kernel."""
+    # Run silently so as not to affect the execution count
+    msg_id = executor.kc.execute(TRACK_INPUTS, silent=True)
+    executor._wait_for_reply(msg_id)
+
+
+def extract_inputs(executor):
+    """Return the execution inputs recorded since 'track_inputs'."""
+    msg_id = executor.kc.execute('', silent=True, user_expressions={
+        'inputs': "__import__('sys')._jupyter_sphinx_inputs()",
+    })
+    reply = executor._wait_for_reply(msg_id)
+    result = reply['content']['user_expressions']['inputs']
+    if result['status'] != 'ok':
+        return None
+    return json.loads(literal_eval(result['data']['text/plain']))
+
+
 def language_info(executor):
     # Can only run this function inside 'setup_preprocessor'
     assert hasattr(executor, 'kc')
@@ -91,24 +203,532 @@ def language_info(executor):
     return info_msg['content']['language_info']
 
 
+class ResourceLimitExceeded(ExtensionError):
+    """A kernel used more memory or CPU time than allowed."""
+    pass
+
+
+def kernel_pid(km):
+    """Return the process id of the kernel started by 'km'."""
+    process = getattr(km, 'kernel', None)
+    if process is None:
+        # jupyter_client >= 7 keeps the process on the provisioner
+        process = getattr(getattr(km, 'provisioner', None), 'process', None)
+    return process.pid
+
+
+class KernelMonitor:
+    """Sample the memory and CPU time of a kernel in a background thread.
+
+    The kernel process and all its children are sampled every 'interval'
+    seconds. When 'memory_limit' (bytes of RSS) or 'cpu_time_limit'
+    (seconds of CPU time used since the monitor started) is exceeded the
+    kernel is interrupted, and killed if it still exceeds the limit
+    'grace' seconds later; 'stop' waits for the end of the grace period
+    of a pending interrupt.
+    """
+
+    def __init__(self, km, memory_limit=None, cpu_time_limit=None,
+                 interval=0.5, grace=5):
+        self.km = km
+        self.memory_limit = memory_limit
+        self.cpu_time_limit = cpu_time_limit
+        self.interval = interval
+        self.grace = grace
+        self.process = psutil.Process(kernel_pid(km))
+        self.peak_memory = 0
+        self.cpu_time = 0
+        self.error = None
+        self.killed = False
+        self._cpu_start = self._sample()[1]
+        self._interrupted_at = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        memory = cpu = 0
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+        except psutil.Error:
+            return memory, cpu
+        for process in processes:
+            try:
+                with process.oneshot():
+                    memory += process.memory_info().rss
+                    times = process.cpu_times()
+                    cpu += times.user + times.system
+            except psutil.Error:
+                # The process exited while we were sampling it
+                continue
+        return memory, cpu
+
+    def _check(self, memory):
+        if self.memory_limit and memory > self.memory_limit:
+            return (
+                'kernel memory use ({:.0f} MiB) exceeded the limit of '
+                '{:.0f} MiB'.format(memory / 2**20, self.memory_limit / 2**20)
+            )
+        if self.cpu_time_limit and self.cpu_time > self.cpu_time_limit:
+            return (
+                'kernel CPU time ({:.1f}s) exceeded the limit of {:.1f}s'
+                .format(self.cpu_time, self.cpu_time_limit)
+            )
+
+    def _update(self):
+        """Take a sample, and return the limit it exceeds, if any."""
+        memory, cpu = self._sample()
+        self.peak_memory = max(self.peak_memory, memory)
+        self.cpu_time = max(self.cpu_time, cpu - self._cpu_start)
+        return self._check(memory)
+
+    def _kill(self):
+        self.killed = True
+        self.km.shutdown_kernel(now=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            error = self._update()
+            if error is None:
+                continue
+            if self._interrupted_at is None:
+                self.error = error
+                self._interrupted_at = time.monotonic()
+                self.km.interrupt_kernel()
+            elif time.monotonic() - self._interrupted_at > self.grace:
+                self._kill()
+                return
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        # Notebooks shorter than 'interval' are otherwise never sampled
+        error = self._update()
+        if self._interrupted_at is None or self.killed:
+            return
+        # Execution stops right after an interrupt, so this is where a
+        # kernel that ignored it is killed.
+        remaining = self._interrupted_at + self.grace - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+            error = self._update()
+        if error is not None:
+            self._kill()
+
+    def usage(self):
+        return {'peak_memory': self.peak_memory, 'cpu_time': self.cpu_time}
+
+    def raise_for_limits(self):
+        if self.error is not None:
+            raise ResourceLimitExceeded(self.error)
+
+
+# Carriage returns followed by a newline just end the line, any other
+# carriage return overwrites what precedes it on the line.
+_CRLF = re.compile(r'\r+\n')
+_OVERWRITTEN = re.compile(r'[^\n]*\r(?=[^\n])')
+
+
+class StreamCapture:
+    """Accumulate the text of one stream output within a size limit.
+
+    Text is coalesced as it is written, with carriage returns applied the
+    way a terminal would. Once more than 'limit' characters would be
+    retained, only the head and the tail of the stream are kept in memory
+    and the full text goes to 'spill_path' instead (if given).
+    """
+
+    def __init__(self, output, limit=None, spill_path=None):
+        self.output = output
+        self.limit = limit
+        self.spill_path = spill_path
+        self.size = 0
+        self._chunks = deque()
+        self._chunks_size = 0
+        self._line = ''
+        self._head = None
+        self._spill = None
+
+    def write(self, text):
+        text = self._line + text
+        end = text.rfind('\n') + 1
+        self._line = _OVERWRITTEN.sub('', text[end:])
+        complete = _OVERWRITTEN.sub('', _CRLF.sub('\n', text[:end]))
+        if self.limit is not None and len(self._line) > self.limit:
+            # A single enormous line; treat it as complete.
+            complete, self._line = complete + self._line, ''
+        if complete:
+            self._add(complete)
+
+    def _add(self, text):
+        self.size += len(text)
+        self._chunks.append(text)
+        self._chunks_size += len(text)
+        if self._spill is not None:
+            self._spill.write(text)
+        elif self._head is None:
+            if self.limit is None or self._chunks_size <= self.limit:
+                return
+            # First time over the limit: keep the head and start spilling
+            text = ''.join(self._chunks)
+            self._head = text[:self.limit // 2]
+            self._chunks = deque([text[len(self._head):]])
+            self._chunks_size = len(self._chunks[0])
+            if self.spill_path is not None:
+                os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+                self._spill = open(self.spill_path, 'w')
+                self._spill.write(text)
+
+        tail_limit = self.limit - len(self._head)
+        while self._chunks_size > tail_limit:
+            excess = self._chunks_size - tail_limit
+            if len(self._chunks[0]) <= excess:
+                self._chunks_size -= len(self._chunks.popleft())
+            else:
+                self._chunks[0] = self._chunks[0][excess:]
+                self._chunks_size -= excess
+
+    def close(self):
+        """Set the retained text on the output and return its length."""
+        if self._line:
+            self._add(self._line)
+            self._line = ''
+        tail = ''.join(self._chunks)
+        if self._head is None:
+            text = tail
+        else:
+            elided = self.size - len(self._head) - len(tail)
+            if self._spill is not None:
+                self._spill.close()
+                marker = (
+                    '\n[... {} characters elided, the full output is in {} ...]\n'
+                    .format(elided, os.path.basename(self.spill_path))
+                )
+            else:
+                marker = '\n[... {} characters elided ...]\n'.format(elided)
+            text = self._head + marker + tail
+        self.output['text'] = text
+        return len(text)
+
+
+def limit_error_output(error):
+    """Return the output shown for a cell that exceeded a resource limit.
+
+    The output so far is kept, followed by the error as for a cell that
+    raised it.
+    """
+    name = type(error).__name__
+    return nbformat.v4.new_output(
+        'error', ename=name, evalue=str(error),
+        traceback=['{}: {}'.format(name, error)],
+    )
+
+
+class SphinxExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor with bounded output capture and kernel monitoring.
+
+    Output messages are processed while each cell runs. Consecutive stream
+    messages are coalesced into a single output, and the text retained is
+    limited to 'cell_output_limit' characters per cell and
+    'notebook_output_limit' characters per notebook, with the full streams
+    spilled to files named after 'spill_prefix' and the index of the cell
+    ('cell_indices' maps the indices of executed cells to these).
+
+    If a 'monitor' is set execution stops as soon as it finds a resource
+    limit exceeded, with the error appended to the outputs of the cell.
+
+    A cell that runs over its timeout is interrupted, and execution fails if
+    the kernel does not become idle within 'interrupt_grace' seconds.
+    """
+
+    monitor = None
+    cell_output_limit = None
+    notebook_output_limit = None
+    spill_prefix = None
+    cell_indices = None
+    interrupt_grace = 5
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._notebook_output_size = 0
+
+    def _deadline(self, cell):
+        if cell is not None and BATCH_TIMEOUT_KEY in cell.metadata:
+            timeout = cell.metadata[BATCH_TIMEOUT_KEY]
+        elif self.timeout_func is not None and cell is not None:
+            timeout = self.timeout_func(cell)
+        else:
+            timeout = self.timeout
+        if timeout and timeout > 0:
+            return time.monotonic() + timeout
+        return None
+
+    def _get_msg(self, channel, deadline):
+        """Get a message from 'channel', or None once 'deadline' passed."""
+        while True:
+            if self.monitor is not None:
+                self.monitor.raise_for_limits()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+            if self.monitor is not None:
+                # Poll, so that we notice an exceeded limit
+                timeout = min(timeout or self.monitor.interval,
+                              self.monitor.interval)
+            try:
+                return channel.get_msg(timeout=timeout)
+            except Empty:
+                continue
+
+    def _timed_out(self):
+        self.log.error("Timeout waiting for execute reply (%is)." % self.timeout)
+        if not self.interrupt_on_timeout:
+            raise TimeoutError("Cell execution timed out")
+        self.log.error("Interrupting kernel")
+        self.km.interrupt_kernel()
+
+    def _wait_for_reply(self, msg_id, cell=None):
+        deadline = self._deadline(cell)
+        while True:
+            msg = self._get_msg(self.kc.shell_channel, deadline)
+            if msg is None:
+                self._timed_out()
+                return None
+            if msg['parent_header'].get('msg_id') == msg_id:
+                return msg
+
+    def _output_limit(self, cell_output_size):
+        limits = []
+        if self.cell_output_limit is not None:
+            limits.append(self.cell_output_limit - cell_output_size)
+        if self.notebook_output_limit is not None:
+            limits.append(
+                self.notebook_output_limit - self._notebook_output_size
+            )
+        return max(0, min(limits)) if limits else None
+
+    def run_cell(self, cell, cell_index=0, store_history=True):
+        msg_id = self.kc.execute(cell.source, store_history=store_history)
+        self.log.debug("Executing cell:\n%s", cell.source)
+
+        # The index of the cell in the notebook as written, which differs
+        # from 'cell_index' when cells were batched
+        if self.cell_indices is not None:
+            source_index = self.cell_indices[cell_index]
+        else:
+            source_index = cell_index
+        outs = cell.outputs = []
+        stream = None  # capture of the last output, if it is a stream
+        n_streams = 0
+        cell_output_size = 0
+        clear_pending = False
+
+        def seal():
+            nonlocal stream, cell_output_size
+            if stream is not None:
+                size = stream.close()
+                cell_output_size += size
+                self._notebook_output_size += size
+                stream = None
+
+        def clear():
+            nonlocal cell_output_size, clear_pending
+            seal()
+            outs[:] = []
+            self._notebook_output_size -= cell_output_size
+            cell_output_size = 0
+            clear_pending = False
+            # clear display_id mapping for this cell
+            for display_id, cell_map in self._display_id_map.items():
+                if cell_index in cell_map:
+                    cell_map[cell_index] = []
+
+        # Process output while the cell runs, rather than letting all the
+        # messages queue up until the execute reply.
+        deadline = self._deadline(cell)
+        interrupted = False
+        while True:
+            try:
+                msg = self._get_msg(self.kc.iopub_channel, deadline)
+            except ResourceLimitExceeded as e:
+                seal()
+                outs.append(limit_error_output(e))
+                raise
+            if msg is None:
+                try:
+                    if interrupted:
+                        raise TimeoutError(
+                            "Kernel did not respond to the interrupt within "
+                            "{}s".format(self.interrupt_grace)
+                        )
+                    self._timed_out()
+                except TimeoutError:
+                    # Close the spill file of the output so far
+                    seal()
+                    raise
+                interrupted = True
+                deadline = time.monotonic() + self.interrupt_grace
+                continue
+            if msg['parent_header'].get('msg_id') != msg_id:
+                # not an output from our execution
+                continue
+
+            msg_type = msg['msg_type']
+            self.log.debug("output: %s", msg_type)
+            content = msg['content']
+
+            # set the prompt number for the input and the output
+            if 'execution_count' in content:
+                cell['execution_count'] = content['execution_count']
+
+            if msg_type == 'status':
+                if content['execution_state'] == 'idle':
+                    break
+                continue
+            elif msg_type == 'execute_input' or msg_type.startswith('comm'):
+                continue
+            elif msg_type == 'clear_output':
+                if content.get('wait'):
+                    clear_pending = True
+                else:
+                    clear()
+                continue
+
+            display_id = None
+            if msg_type in {'execute_result', 'display_data',
+                            'update_display_data'}:
+                display_id = content.get('transient', {}).get('display_id')
+                if display_id:
+                    self._update_display_id(display_id, msg)
+                if msg_type == 'update_display_data':
+                    # update_display_data doesn't get recorded
+                    continue
+
+            if clear_pending:
+                clear()
+
+            if msg_type == 'stream':
+                if stream is None or stream.output.name != content['name']:
+                    seal()
+                    output = nbformat.v4.new_output(
+                        'stream', name=content['name'], text=''
+                    )
+                    spill_path = None
+                    if self.spill_prefix is not None:
+                        n_streams += 1
+                        spill_path = '{}_{}_{}.txt'.format(
+                            self.spill_prefix, source_index, n_streams
+                        )
+                    stream = StreamCapture(
+                        output, self._output_limit(cell_output_size),
+                        spill_path,
+                    )
+                    outs.append(output)
+                stream.write(content['text'])
+                continue
+
+            seal()
+            try:
+                out = output_from_msg(msg)
+            except ValueError:
+                self.log.error("unhandled iopub msg: " + msg_type)
+                continue
+            if display_id:
+                # record output index in:
+                #   _display_id_map[display_id][cell_idx]
+                cell_map = self._display_id_map.setdefault(display_id, {})
+                output_idx_list = cell_map.setdefault(cell_index, [])
+                output_idx_list.append(len(outs))
+
+            outs.append(out)
+
+        seal()
+        try:
+            exec_reply = self._wait_for_reply(msg_id, cell)
+        except ResourceLimitExceeded as e:
+            outs.append(limit_error_output(e))
+            raise
+        return exec_reply, outs
+
+
 # Vendored from 'nbconvert.preprocessors.executenb' with modifications
 # to extract widget state from the kernel after execution and store it
 # in the notebook metadata.
 # TODO: Remove this once  https://github.com/jupyter/nbconvert/pull/900
 #       is merged and a new version of nbconvert is released.
-def executenb(nb, cwd=None, km=None, **kwargs):
-    """Execute a notebook and embed widget state."""
+def executenb(nb, cwd=None, km=None, memory_limit=None, cpu_time_limit=None,
+              cell_output_limit=None, notebook_output_limit=None,
+              spill_prefix=None, cell_indices=None,
+              track_execution_inputs=False, **kwargs):
+    """Execute a notebook and embed widget state.
+
+    If 'psutil' is installed the kernel's resource use is monitored, and
+    the returned resources contain it under 'resource_usage'. If a limit is
+    exceeded execution stops, keeping the outputs so far, and the error is
+    returned under 'resource_limit_exceeded'.
+
+    If 'track_execution_inputs' is True and the kernel is Python, the files
+    that the kernel reads (outside the Python installation), and the
+    modification times of the site-packages directories on the kernel's
+    'sys.path', are returned under 'execution_inputs'.
+    """
     resources = {}
     if cwd is not None:
         resources['metadata'] = {'path': cwd}
-    ep = ExecutePreprocessor(**kwargs)
+    ep = SphinxExecutePreprocessor(**kwargs)
+    ep.cell_output_limit = cell_output_limit
+    ep.notebook_output_limit = notebook_output_limit
+    ep.spill_prefix = spill_prefix
+    ep.cell_indices = cell_indices
+    if km is not None and not km.has_kernel:
+        # nbconvert < 5.6 fails to start the kernel of a given manager
+        km.start_kernel(extra_arguments=ep.extra_arguments)
     with ep.setup_preprocessor(nb, resources, km=km):
-        ep.log.info("Executing notebook with kernel: %s" % ep.kernel_name)
-        nb, resources = super(ExecutePreprocessor, ep).preprocess(nb, resources)
-        nb.metadata.language_info = language_info(ep)
-        widgets = extract_widget_state(ep)
-        if widgets:
-            nb.metadata.widgets = {WIDGET_STATE_MIMETYPE: widgets}
+        try:
+            ep.log.info("Executing notebook with kernel: %s" % ep.kernel_name)
+            info = language_info(ep)
+            track = track_execution_inputs and info['name'] == 'python'
+            if track:
+                track_inputs(ep)
+            if psutil is not None:
+                ep.monitor = KernelMonitor(ep.km, memory_limit, cpu_time_limit)
+                ep.monitor.start()
+            try:
+                nb, resources = super(ExecutePreprocessor, ep).preprocess(
+                    nb, resources
+                )
+            except ResourceLimitExceeded:
+                # 'nb' and 'resources' were modified in-place
+                pass
+            finally:
+                if ep.monitor is not None:
+                    ep.monitor.stop()
+            aborted = False
+            if ep.monitor is not None:
+                resources['resource_usage'] = ep.monitor.usage()
+                if ep.monitor.error is not None:
+                    resources['resource_limit_exceeded'] = ep.monitor.error
+                    aborted = True
+            nb.metadata.language_info = info
+            # After an exceeded limit the kernel may be dead, or still busy
+            # if it ignored the interrupt, so it is not queried again.
+            if not aborted:
+                if track:
+                    resources['execution_inputs'] = extract_inputs(ep)
+                widgets = extract_widget_state(ep)
+                if widgets:
+                    nb.metadata.widgets = {WIDGET_STATE_MIMETYPE: widgets}
+        finally:
+            if km is not None:
+                # setup_preprocessor only stops the client of kernels
+                # that it started itself
+                ep.kc.stop_channels()
+    return resources
 
 
 def split_on(pred, it):
@@ -131,11 +751,51 @@ class Cell(docutils.nodes.container):
     """Container for input/output from Jupyter kernel"""
     pass
 
+class KernelSessions:
+    """Long-lived kernels shared between the documents of a session.
+
+    Each session named with the ``:session:`` option of ``jupyter-kernel``
+    gets a single kernel manager that lives for the whole build; the kernel
+    is started lazily by ``executenb`` and shut down at ``build-finished``.
+    """
+
+    def __init__(self):
+        self.managers = {}
+
+    def get(self, session, kernel_name):
+        try:
+            km = self.managers[session]
+        except KeyError:
+            km = self.managers[session] = KernelManager(kernel_name=kernel_name)
+        if km.kernel_name != kernel_name:
+            raise ExtensionError(
+                'Kernel session "{}" was started with kernel "{}", '
+                'cannot reuse it with kernel "{}"'
+                .format(session, km.kernel_name, kernel_name)
+            )
+        return km
+
+    def discard(self, session):
+        """Shut down the kernel of 'session', so that it starts afresh."""
+        km = self.managers.pop(session, None)
+        if km is not None and km.has_kernel:
+            km.shutdown_kernel(now=True)
+
+    def shutdown(self):
+        for session in list(self.managers):
+            self.discard(session)
+
+
 class KernelNode(docutils.nodes.Element):
     """Dummy node for signaling a new kernel"""
     pass
 
 
+class MimeBundleNode(docutils.nodes.Element):
+    """Alternative renderings of an output, one container per mime type"""
+    pass
+
+
 def visit_container(self, node):
     self.visit_container(node)
 
@@ -152,6 +812,7 @@ class JupyterKernel(Directive):
 
     option_spec = {
         'id': directives.unchanged,
+        'session': directives.unchanged,
     }
 
     def run(self):
@@ -160,6 +821,7 @@ class JupyterKernel(Directive):
             '',
             kernel_name=kernel_name.strip(),
             kernel_id=self.options.get('id', '').strip(),
+            session=self.options.get('session', '').strip(),
         )]
 
 
@@ -224,14 +886,123 @@ def jupyter_download_role(name, rawtext, text, lineno, inliner):
     return [node], []
 
 
-def cell_output_to_nodes(cell, data_priority, dir):
+def render_image(output, mime_type, dir):
+    # Sphinx treats absolute paths as being rooted at the source
+    # directory, so make a relative path, which Sphinx treats
+    # as being relative to the current working directory.
+    filename = os.path.basename(output.metadata['filenames'][mime_type])
+    uri = os.path.join(dir, filename)
+    return [docutils.nodes.image(uri=uri)]
+
+
+def render_html(output, mime_type, dir):
+    return [docutils.nodes.raw(
+        text=output['data'][mime_type],
+        format='html'
+    )]
+
+
+def render_latex(output, mime_type, dir):
+    latex = output['data'][mime_type]
+    return [docutils.nodes.math_block(
+        latex, latex,
+        nowrap=False,
+        number=None,
+    )]
+
+
+def render_plain(output, mime_type, dir):
+    data = output['data'][mime_type]
+    return [docutils.nodes.literal_block(
+        text=data,
+        rawsource=data,
+        language='ipython',
+    )]
+
+
+def render_widget_view(output, mime_type, dir):
+    data = output['data'][mime_type]
+    return [docutils.nodes.raw(
+        text='<script type="{mime_type}">{data}</script>'
+             .format(mime_type=mime_type, data=json.dumps(data)),
+        format='html',
+    )]
+
+
+# Functions that render output data of a given mime type as doctree nodes.
+# They are called as 'renderer(output, mime_type, dir)', with the arguments
+# described in 'cell_output_to_nodes', and return a list of nodes.
+MIME_RENDERERS = {
+    WIDGET_VIEW_MIMETYPE: render_widget_view,
+    'text/html': render_html,
+    'image/svg+xml': render_image,
+    'image/png': render_image,
+    'image/jpeg': render_image,
+    'application/pdf': render_image,
+    'text/latex': render_latex,
+    'text/plain': render_plain,
+}
+
+# Mime types to prefer, by builder name or format; 'default' is used for
+# builders not listed.
+DATA_PRIORITY = {
+    'html': [
+        WIDGET_VIEW_MIMETYPE,
+        'text/html',
+        'image/svg+xml',
+        'image/png',
+        'image/jpeg',
+        'text/latex',
+        'text/plain'
+    ],
+    'latex': [
+        'application/pdf',
+        'image/png',
+        'image/jpeg',
+        'text/latex',
+        'text/plain'
+    ],
+    'default': [
+        'image/png',
+        'image/jpeg',
+        'text/plain'
+    ],
+}
+
+
+def add_mime_renderer(app, mime_type, renderer):
+    """Register 'renderer' for output data of 'mime_type'.
+
+    For use by other extensions in their 'setup'; the mime type must also
+    appear in 'jupyter_execute_data_priority' to be used.
+    """
+    app.jupyter_mime_renderers[mime_type] = renderer
+
+
+def compile_data_priority(data_priority, renderers):
+    """Map each renderable mime type in 'data_priority' to its rank."""
+    table = {}
+    for rank, mime_type in enumerate(data_priority):
+        if mime_type not in renderers:
+            logger.warning(
+                'No renderer for mime type "{}" in '
+                'jupyter_execute_data_priority'.format(mime_type)
+            )
+            continue
+        table.setdefault(mime_type, rank)
+    return table
+
+
+def cell_output_to_nodes(cell, renderers, dir):
     """Convert a jupyter cell with outputs and filenames to doctree nodes.
 
     Parameters
     ==========
     cell : jupyter cell
-    data_priority : list of mime types
-        Which media types to prioritize.
+    renderers : dict
+        Maps mime types to renderers. Each output is rendered in all the
+        mime types it has a renderer for, as alternatives in a
+        'MimeBundleNode'; the best one for the builder is chosen later.
     dir : string
         Sphinx "absolute path" to the output folder, so it is a relative path
         to the source folder prefixed with ``/``.
@@ -239,14 +1010,12 @@ def cell_output_to_nodes(cell, data_priority, dir):
     to_add = []
     for index, output in enumerate(cell.get('outputs', [])):
         output_type = output['output_type']
-        if (
-            output_type == 'stream'
-            and output['name'] == 'stdout'
-        ):
+        if output_type == 'stream':
             to_add.append(docutils.nodes.literal_block(
                 text=output['text'],
                 rawsource=output['text'],
-                language='ipython',
+                language='ipython' if output['name'] == 'stdout' else 'none',
+                classes=[output['name']],
             ))
         elif (
             output_type == 'error'
@@ -261,59 +1030,62 @@ def cell_output_to_nodes(cell, data_priority, dir):
         elif (
             output_type in ('display_data', 'execute_result')
         ):
-            try:
-                # First mime_type by priority that occurs in output.
-                mime_type = next(
-                    x for x in data_priority if x in output['data']
-                )
-            except StopIteration:
-                continue
-
-            data = output['data'][mime_type]
-            if mime_type.startswith('image'):
-                # Sphinx treats absolute paths as being rooted at the source
-                # directory, so make a relative path, which Sphinx treats
-                # as being relative to the current working directory.
-                filename = os.path.basename(
-                    output.metadata['filenames'][mime_type]
+            bundle = MimeBundleNode()
+            for mime_type in output['data']:
+                if mime_type not in renderers:
+                    continue
+                render = renderers[mime_type]
+                bundle += docutils.nodes.container(
+                    '', *render(output, mime_type, dir), mime_type=mime_type
                 )
-                uri = os.path.join(dir, filename)
-                to_add.append(docutils.nodes.image(uri=uri))
-            elif mime_type == 'text/html':
-                to_add.append(docutils.nodes.raw(
-                    text=data,
-                    format='html'
-                ))
-            elif mime_type == 'text/latex':
-                to_add.append(displaymath(
-                    latex=data,
-                    nowrap=False,
-                    number=None,
-                 ))
-            elif mime_type == 'text/plain':
-                to_add.append(docutils.nodes.literal_block(
-                    text=data,
-                    rawsource=data,
-                    language='ipython',
-                ))
-            elif mime_type == WIDGET_VIEW_MIMETYPE:
-                to_add.append(docutils.nodes.raw(
-                    text='<script type="{mime_type}">{data}</script>'
-                         .format(mime_type=mime_type, data=json.dumps(data)),
-                    format='html',
-                ))
+            if bundle.children:
+                to_add.append(bundle)
 
     return to_add
 
 
+def notebook_outputs_to_nodes(notebook, renderers, dir):
+    """Convert the outputs of all cells in 'notebook' to doctree nodes.
+
+    Returns a list with the output nodes of each cell; see
+    'cell_output_to_nodes' for the parameters.
+    """
+    return [cell_output_to_nodes(cell, renderers, dir)
+            for cell in notebook.cells]
+
+
+class SelectMimeType(SphinxPostTransform):
+    """Replace each MimeBundleNode by its best alternative for the builder.
+
+    This is done when writing rather than when reading, as the doctrees
+    may be shared between builders.
+    """
+    default_priority = 40
+
+    def run(self):
+        priority = self.app.jupyter_data_priority
+        for bundle in self.document.traverse(MimeBundleNode):
+            alternatives = [
+                alternative for alternative in bundle.children
+                if alternative['mime_type'] in priority
+            ]
+            if not alternatives:
+                bundle.parent.remove(bundle)
+                continue
+            best = min(alternatives, key=lambda x: priority[x['mime_type']])
+            bundle.replace_self(best.children)
+
+
 def attach_outputs(output_nodes, node):
+    # Use the docutils list API, which sets the parent of the output nodes;
+    # SelectMimeType replaces the bundles among them through their parent.
     if node.attributes['hide_code']:
-        node.children = []
+        node.clear()
     if not node.attributes['hide_output']:
         if node.attributes['code_below']:
-            node.children = output_nodes + node.children
+            node[0:0] = output_nodes
         else:
-            node.children = node.children + output_nodes
+            node.extend(output_nodes)
 
 
 def default_notebook_names(basename):
@@ -323,24 +1095,222 @@ def default_notebook_names(basename):
         yield '_'.join((basename, str(i)))
 
 
-def execute_cells(kernel_name, cells, execute_kwargs):
-    """Execute Jupyter cells in the specified kernel."""
+# Cell metadata holding the timeout of a whole batch
+BATCH_TIMEOUT_KEY = 'jupyter_sphinx_batch_timeout'
+
+# Kernel code running a batch of sources. Each source is interrupted, as the
+# kernel would be, once it runs over its own timeout, and an interrupted
+# source stops the rest of the batch.
+RUN_BATCH = """\
+def _jupyter_sphinx_run_batch(sources, timeouts):
+    import os, signal, threading, _thread
+    if os.name == 'nt':
+        interrupt = _thread.interrupt_main
+    else:
+        def interrupt():
+            os.kill(os.getpid(), signal.SIGINT)
+    for source, timeout in zip(sources, timeouts):
+        timer = None
+        if timeout is not None and timeout > 0:
+            timer = threading.Timer(timeout, interrupt)
+            timer.start()
+        try:
+            result = get_ipython().run_cell(source, store_history=True)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if isinstance(result.error_in_exec, KeyboardInterrupt):
+            break
+try:
+    _jupyter_sphinx_run_batch(
+        {},
+        {},
+    )
+finally:
+    del _jupyter_sphinx_run_batch
+"""
+
+
+def cell_timeout(cell, execute_kwargs):
+    """Return the timeout that 'execute_kwargs' sets for 'cell'."""
+    timeout_func = execute_kwargs.get('timeout_func')
+    if timeout_func is not None:
+        return timeout_func(cell)
+    return execute_kwargs.get(
+        'timeout', ExecutePreprocessor.timeout.default_value
+    )
+
+
+def batch_cells(cells, batchable, timeouts):
+    """Merge runs of batchable cells into single cells.
+
+    Each run of two or more consecutive cells for which 'batchable' is True
+    is replaced by one cell that runs the original sources one after the
+    other with IPython's 'run_cell', so that each keeps its own execution,
+    error handling and traceback line numbers. Each source is interrupted
+    after its own entry in 'timeouts', which also stops the rest of its
+    batch.
+
+    Returns the cells to execute and, for each of them, the indices of the
+    original cells that it runs.
+    """
+    groups = []
+    for is_batchable, run in groupby(enumerate(batchable), itemgetter(1)):
+        indices = [index for index, _ in run]
+        if is_batchable:
+            groups.append(indices)
+        else:
+            groups.extend([index] for index in indices)
+
+    batched = []
+    for indices in groups:
+        if len(indices) == 1:
+            batched.append(cells[indices[0]])
+            continue
+        batch_timeouts = [timeouts[i] for i in indices]
+        cell = nbformat.v4.new_code_cell(RUN_BATCH.format(
+            repr([cells[i].source for i in indices]), repr(batch_timeouts)
+        ))
+        if all(timeout is not None and timeout > 0
+               for timeout in batch_timeouts):
+            # Only reached if the kernel fails to interrupt a source itself
+            cell.metadata[BATCH_TIMEOUT_KEY] = sum(batch_timeouts)
+        else:
+            cell.metadata[BATCH_TIMEOUT_KEY] = None
+        batched.append(cell)
+    return batched, groups
+
+
+def unbatch_cells(cells, batched, groups):
+    """Put the outputs of executed batched cells back on the original cells.
+
+    All the outputs of a batch are attributed to the last cell of the batch.
+    """
+    for executed, indices in zip(batched, groups):
+        if len(indices) == 1:
+            cells[indices[0]] = executed
+        else:
+            cells[indices[-1]].outputs = executed.outputs
+    return cells
+
+
+def execute_cells(kernel_name, cells, execute_kwargs, km=None,
+                  batchable=None):
+    """Execute Jupyter cells in the specified kernel.
+
+    If 'km' is given the cells are run in that (possibly already running)
+    kernel, which is left running afterwards.
+
+    If 'batchable' is given it flags the cells whose outputs are not needed
+    individually; runs of these are executed in a single request when the
+    kernel is IPython, errors are allowed and cells that time out are
+    interrupted (so that a failing or interrupted cell does not stop the
+    rest of the notebook, as it would not without batching).
+
+    Returns the executed notebook and the resources returned by 'executenb'.
+    """
     notebook = blank_nb(kernel_name)
-    notebook.cells = cells
+    groups = None
+    if (
+        batchable is not None
+        and notebook.metadata.kernelspec.language == 'python'
+        and execute_kwargs.get('allow_errors')
+    ):
+        timeouts = [cell_timeout(cell, execute_kwargs) for cell in cells]
+        interrupt_on_timeout = execute_kwargs.get(
+            'interrupt_on_timeout',
+            ExecutePreprocessor.interrupt_on_timeout.default_value,
+        )
+        if interrupt_on_timeout or not any(
+            timeout is not None and timeout > 0 for timeout in timeouts
+        ):
+            notebook.cells, groups = batch_cells(cells, batchable, timeouts)
+    if groups is None:
+        notebook.cells = cells
+        cell_indices = None
+    else:
+        # Spilled output is named after the cell that the outputs end up on
+        cell_indices = [indices[-1] for indices in groups]
     # Modifies 'notebook' in-place
     try:
-        executenb(notebook, **execute_kwargs)
+        resources = executenb(
+            notebook, km=km, cell_indices=cell_indices, **execute_kwargs
+        )
     except Exception as e:
         raise ExtensionError('Notebook execution failed', orig_exc=e)
 
-    return notebook
+    if groups is not None:
+        notebook.cells = unbatch_cells(cells, notebook.cells, groups)
+
+    return notebook, resources
+
+
+class OutputWriter:
+    """Write files from a background thread.
+
+    At most 'max_pending' writes are queued at a time; 'submit' blocks
+    until there is room. 'flush' waits for all queued writes and raises
+    the first error that occurred in any of them.
+    """
+
+    def __init__(self, max_pending=16):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._error = None
+
+    def _done(self, future):
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+        self._slots.release()
+
+    def submit(self, func, *args):
+        self._slots.acquire()
+        self._executor.submit(func, *args).add_done_callback(self._done)
+
+    def flush(self):
+        # Once we hold every slot, nothing is queued or being written
+        for _ in range(self.max_pending):
+            self._slots.acquire()
+        for _ in range(self.max_pending):
+            self._slots.release()
+        error, self._error = self._error, None
+        if error is not None:
+            raise ExtensionError('Writing notebook output failed',
+                                 orig_exc=error)
+
+
+def write_file(filename, contents, mode='w'):
+    with open(filename, mode) as f:
+        f.write(contents)
 
 
-def write_notebook_output(notebook, output_dir, notebook_name):
+def write_notebook(notebook, filename, lean=False):
+    if lean:
+        # Compact JSON, without the schema validation done by nbformat
+        contents = json.dumps(notebook, sort_keys=True, separators=(',', ':'))
+    else:
+        contents = nbformat.writes(notebook)
+    write_file(filename, contents.encode('utf-8'), 'wb')
+
+
+def write_script(notebook, filename):
+    contents = '\n\n'.join(cell.source for cell in notebook.cells)
+    write_file(filename, contents)
+
+
+def write_notebook_output(notebook, output_dir, notebook_name, downloads=(),
+                          lean=False, writer=None):
     """Extract output from notebook cells and write to files in output_dir.
 
     This also modifies 'notebook' in-place, adding metadata to each cell that
     maps output mime-types to the filenames the output was saved under.
+
+    The extracted outputs, and the notebook and script files whose
+    extensions are in 'downloads', are written immediately, as Sphinx
+    checks that images and downloads exist when it has read the document.
+    The other notebook and script files are written by 'writer' if given,
+    or not at all if 'lean' is True (which also skips notebook validation).
     """
     resources = dict(
         unique_key=os.path.join(output_dir, notebook_name),
@@ -349,16 +1319,26 @@ def write_notebook_output(notebook, output_dir, notebook_name):
 
     # Modifies 'resources' in-place
     ExtractOutputPreprocessor().preprocess(notebook, resources)
-    # Write the cell outputs to files where we can (images and PDFs),
-    # as well as the notebook file.
-    FilesWriter(build_directory=output_dir).write(
-        nbformat.writes(notebook), resources,
-        os.path.join(output_dir, notebook_name + '.ipynb')
+    os.makedirs(output_dir, exist_ok=True)
+    # Write the cell outputs to files where we can (images and PDFs).
+    for filename, data in resources['outputs'].items():
+        write_file(os.path.join(output_dir, filename), data, 'wb')
+
+    # Write the notebook file and a Python script too.
+    artifacts = (
+        ('.ipynb', partial(write_notebook, notebook, lean=lean)),
+        ('.py', partial(write_script, notebook)),
     )
-    # Write a Python script too.
-    contents = '\n\n'.join(cell.source for cell in notebook.cells)
-    with open(os.path.join(output_dir, notebook_name + '.py'), 'w') as f:
-        f.write(contents)
+    for ext, write in artifacts:
+        filename = os.path.join(output_dir, notebook_name + ext)
+        if ext in downloads:
+            write(filename)
+        elif lean:
+            continue
+        elif writer is not None:
+            writer.submit(write, filename)
+        else:
+            write(filename)
 
 
 def output_directory(env):
@@ -374,7 +1354,7 @@ def output_directory(env):
     ))
 
 
-def sphinx_abs_dir(env):
+def sphinx_abs_dir(env, docname=None):
     # We write the output files into
     # output_directory / jupyter_execute / path relative to source directory
     # Sphinx expects download links relative to source file or relative to
@@ -382,7 +1362,7 @@ def sphinx_abs_dir(env):
     return '/' + os.path.relpath(
         os.path.abspath(os.path.join(
             output_directory(env),
-            os.path.dirname(env.docname),
+            os.path.dirname(docname or env.docname),
         )),
         os.path.abspath(env.app.srcdir)
     )
@@ -391,6 +1371,38 @@ def sphinx_abs_dir(env):
 class ExecuteJupyterCells(SphinxTransform):
     default_priority = 180  # An early transform, idk
 
+    def note_execution_inputs(self, kernel_name, inputs):
+        """Record what the execution of the current document depends on.
+
+        Files read by the kernel become ordinary Sphinx dependencies, except
+        for the files that Sphinx and this extension write; the rest is
+        checked by 'get_outdated_executions'.
+        """
+        record = self.env.jupyter_execution_inputs.setdefault(
+            self.env.docname,
+            dict(
+                kwargs=execute_kwargs_fingerprint(self.config),
+                renderers=renderers_fingerprint(self.app),
+                kernels={},
+                paths={},
+            ),
+        )
+        record['kernels'][kernel_name] = kernel_spec_fingerprint(kernel_name)
+        if inputs is None:
+            return
+        record['paths'].update(inputs['paths'])
+        outputs = tuple(
+            os.path.join(os.path.abspath(path), '') for path in (
+                output_directory(self.env),
+                self.app.outdir,
+                self.app.doctreedir,
+            )
+        )
+        for filename in inputs['files']:
+            # Sphinx considers documents depending on missing files outdated
+            if os.path.isfile(filename) and not filename.startswith(outputs):
+                self.env.note_dependency(filename)
+
     def apply(self):
         doctree = self.document
         doc_relpath = os.path.dirname(self.env.docname)  # relative to src dir
@@ -404,6 +1416,11 @@ class ExecuteJupyterCells(SphinxTransform):
 
         logger.info('executing {}'.format(docname))
         output_dir = os.path.join(output_directory(self.env), doc_relpath)
+        download_dir = sphinx_abs_dir(self.env)
+        download_targets = self.app.jupyter_download_targets | {
+            download_key(node['reftarget'])
+            for node in doctree.traverse(download_reference)
+        }
 
         # Start new notebook whenever a KernelNode is encountered
         nodes_by_notebook = split_on(
@@ -412,39 +1429,111 @@ class ExecuteJupyterCells(SphinxTransform):
         )
 
         for first, *nodes in nodes_by_notebook:
+            session = None
             if isinstance(first, KernelNode):
                 kernel_name = first['kernel_name'] or default_kernel
                 file_name = first['kernel_id'] or next(default_names)
+                session = first['session'] or None
             else:
                 nodes = (first, *nodes)
                 kernel_name = default_kernel
                 file_name = next(default_names)
 
-            notebook = execute_cells(
+            km = None
+            if session:
+                self.env.jupyter_sessions.setdefault(session, set()).add(
+                    self.env.docname
+                )
+                # The order in which the session actually executed
+                runs = self.env.jupyter_session_runs.setdefault(session, [])
+                if self.env.docname not in runs:
+                    runs.append(self.env.docname)
+                km = self.app.jupyter_kernel_sessions.get(session, kernel_name)
+
+            batchable = None
+            if self.config.jupyter_execute_batch_cells:
+                # The output of hidden cells is never shown, so it does
+                # not matter which cell it is attributed to.
+                batchable = [node['hide_output'] for node in nodes]
+
+            execute_kwargs = dict(
+                self.config.jupyter_execute_kwargs,
+                memory_limit=self.config.jupyter_execute_memory_limit,
+                cpu_time_limit=self.config.jupyter_execute_cpu_time_limit,
+                cell_output_limit=self.config.jupyter_execute_cell_output_limit,
+                notebook_output_limit=(
+                    self.config.jupyter_execute_notebook_output_limit
+                ),
+                spill_prefix=os.path.join(output_dir, file_name),
+                track_execution_inputs=True,
+            )
+            notebook, resources = execute_cells(
                 kernel_name,
                 [nbformat.v4.new_code_cell(node.astext()) for node in nodes],
-                self.config.jupyter_execute_kwargs,
+                execute_kwargs,
+                km=km,
+                batchable=batchable,
+            )
+            error = resources.get('resource_limit_exceeded')
+            if error is not None:
+                if session:
+                    # The kernel may still hold the memory, or be dead;
+                    # the rest of the session runs in a fresh one.
+                    self.app.jupyter_kernel_sessions.discard(session)
+                if self.config.jupyter_execute_fail_on_resource_limit:
+                    raise ResourceLimitExceeded(
+                        'Execution of notebook "{}" in document "{}" was '
+                        'aborted: {}'.format(file_name, self.env.docname, error)
+                    )
+                logger.error(
+                    'Execution of notebook "{}" was aborted: {}'
+                    .format(file_name, error),
+                    location=self.env.docname,
+                )
+            if 'resource_usage' in resources:
+                self.env.jupyter_resource_usage.setdefault(
+                    self.env.docname, {}
+                )[file_name] = resources['resource_usage']
+            self.note_execution_inputs(
+                kernel_name, resources.get('execution_inputs')
             )
 
             # Modifies 'notebook' in-place, adding metadata specifying the
             # filenames of the saved outputs.
-            write_notebook_output(notebook, output_dir, file_name)
+            downloads = {
+                ext for ext in ('.ipynb', '.py')
+                if download_key(os.path.join(download_dir, file_name + ext))
+                in download_targets
+            }
+            lean = self.config.jupyter_execute_lean_notebooks
+            write_notebook_output(
+                notebook, output_dir, file_name,
+                downloads=downloads,
+                lean=lean,
+                writer=self.app.jupyter_output_writer,
+            )
+            if lean:
+                self.env.jupyter_skipped_downloads.setdefault(
+                    self.env.docname, set()
+                ).update(
+                    download_key(os.path.join(download_dir, file_name + ext))
+                    for ext in ('.ipynb', '.py') if ext not in downloads
+                )
             # Add doctree nodes for cell output; images reference the filenames
             # we just wrote to; sphinx copies these when writing outputs.
-            for node, cell in zip(nodes, notebook.cells):
-                output_nodes = cell_output_to_nodes(
-                    cell,
-                    self.config.jupyter_execute_data_priority,
-                    sphinx_abs_dir(self.env)
-                )
+            all_output_nodes = notebook_outputs_to_nodes(
+                notebook, self.app.jupyter_output_renderers, download_dir
+            )
+            for node, output_nodes in zip(nodes, all_output_nodes):
                 attach_outputs(output_nodes, node)
 
             if contains_widgets(notebook):
                 # Write the widget state to a separate file (it may be large)
                 filename = os.path.join(output_dir,
-                                        notebook_name + '_widget-state.json')
-                with open(filename, 'w') as f:
-                    f.write(json.dumps(get_widgets(notebook)))
+                                        file_name + '_widget-state.json')
+                self.app.jupyter_output_writer.submit(
+                    write_file, filename, json.dumps(get_widgets(notebook))
+                )
                 # Append widget state JSON to document (if it exists)
                 # XXX: Can we specify a javascript node directly, rather than
                 # a 'raw' node of 'html' format?
@@ -455,32 +1544,429 @@ class ExecuteJupyterCells(SphinxTransform):
                 ))
 
 
+def toctree_order(env):
+    """Return the docnames reachable from the master document in toctree order.
+
+    This uses the toctrees currently recorded in the environment, so
+    documents that have not been read yet are not included.
+    """
+    order = []
+    seen = set()
+
+    def visit(docname):
+        if docname in seen:
+            return
+        seen.add(docname)
+        order.append(docname)
+        for child in env.toctree_includes.get(docname, []):
+            visit(child)
+
+    visit(env.config.master_doc)
+    return order
+
+
+def session_order(members, position):
+    """Sort 'members' by toctree 'position', unknown documents last."""
+    return sorted(
+        members,
+        key=lambda docname: (position.get(docname, len(position)), docname),
+    )
+
+
+def stale_sessions(env):
+    """Return the sessions that did not execute as they should have.
+
+    A session is stale if the documents it last executed, in the order it
+    executed them, differ from its current members in toctree order. This
+    happens when documents join or leave a session, when the toctree is
+    reordered, and when a session executed before its toctree was known.
+
+    Returns a list of (session, members in toctree order).
+    """
+    sessions = getattr(env, 'jupyter_sessions', {})
+    runs = getattr(env, 'jupyter_session_runs', {})
+    position = {docname: i for i, docname in enumerate(toctree_order(env))}
+    stale = []
+    for session in sorted(set(sessions) | set(runs)):
+        members = session_order(sessions.get(session, ()), position)
+        if runs.get(session, []) != members:
+            stale.append((session, members))
+    return stale
+
+
+def init_sessions(app, env, docnames):
+    """Re-read whole kernel sessions, in toctree order.
+
+    If any document belonging to a kernel session is outdated, all the
+    documents of that session are read again, as later documents depend
+    on the kernel state created by earlier ones. Session documents are
+    then reordered (in place, keeping the slots they occupy in 'docnames')
+    so that they execute in toctree order, as far as it is known; see
+    'rerun_sessions' for when it is not.
+    """
+    if not hasattr(env, 'jupyter_sessions'):
+        env.jupyter_sessions = {}
+    if not hasattr(env, 'jupyter_session_runs'):
+        env.jupyter_session_runs = {}
+
+    outdated = set(docnames)
+    for session, members in env.jupyter_sessions.items():
+        if members & outdated:
+            docnames.extend(sorted(members - outdated))
+            outdated |= members
+            env.jupyter_session_runs[session] = []
+
+    in_session = set().union(*env.jupyter_sessions.values())
+    positions = [i for i, docname in enumerate(docnames)
+                 if docname in in_session]
+    if not positions:
+        return
+
+    position = {docname: i for i, docname in enumerate(toctree_order(env))}
+    ordered = session_order((docnames[i] for i in positions), position)
+    for i, docname in zip(positions, ordered):
+        docnames[i] = docname
+
+
+def get_outdated_sessions(app, env, added, changed, removed):
+    """Return the members of sessions that did not execute in toctree order."""
+    # Some Sphinx versions pass the builder rather than the environment
+    env = app.env
+    already_outdated = added | changed | removed
+    return [
+        docname
+        for _, members in stale_sessions(env)
+        for docname in members
+        if docname not in already_outdated
+    ]
+
+
+def rerun_sessions(app, env):
+    """Re-execute the sessions that did not execute in toctree order.
+
+    Only once all documents are read are the toctrees known, so sessions
+    executed out of order (e.g. in a fresh build, or after the toctree
+    was reordered), or executed without all their members (after a
+    document joined the session), are now read again, in a fresh kernel.
+    """
+    rerun = []
+    for _ in range(3):
+        stale = stale_sessions(env)
+        if not stale:
+            break
+        for session, members in stale:
+            app.jupyter_kernel_sessions.discard(session)
+            env.jupyter_session_runs[session] = []
+            if not members:
+                del env.jupyter_session_runs[session]
+                env.jupyter_sessions.pop(session, None)
+                continue
+            logger.info(
+                're-executing kernel session "{}" in toctree order'
+                .format(session)
+            )
+            for docname in members:
+                app.emit('env-purge-doc', env, docname)
+                env.clear_doc(docname)
+                app.builder.read_doc(docname)
+            rerun.extend(members)
+    else:
+        logger.warning(
+            'Kernel sessions {} did not settle on an execution order'
+            .format(', '.join(session for session, _ in stale_sessions(env)))
+        )
+
+    in_toctree = set(toctree_order(env))
+    for session, members in sorted(getattr(env, 'jupyter_sessions', {}).items()):
+        unordered = sorted(members - in_toctree)
+        if unordered:
+            logger.warning(
+                'Documents {} of kernel session "{}" are not in any toctree, '
+                'so they were executed in alphabetical order after the others'
+                .format(', '.join(unordered), session)
+            )
+    return rerun
+
+
+def purge_sessions(app, env, docname):
+    for members in getattr(env, 'jupyter_sessions', {}).values():
+        members.discard(docname)
+
+
+def shutdown_sessions(app, exception):
+    app.jupyter_kernel_sessions.shutdown()
+
+
+def check_resource_limits(app, config):
+    if psutil is None and (config.jupyter_execute_memory_limit
+                           or config.jupyter_execute_cpu_time_limit):
+        raise ExtensionError(
+            "'psutil' must be installed to use jupyter_execute_memory_limit "
+            "or jupyter_execute_cpu_time_limit"
+        )
+
+
+def init_kernel_specs(app, config):
+    """Resolve kernel specs afresh, failing early on a missing default."""
+    kernel_spec.cache_clear()
+    notebook_metadata.cache_clear()
+    kernel_spec(config.jupyter_execute_default_kernel)
+
+
+def compile_renderers(app, config):
+    """Precompile the mime type priorities of each builder.
+
+    Outputs are rendered in every mime type that some builder may use.
+    """
+    renderers = dict(app.jupyter_mime_renderers)
+    renderers.update(config.jupyter_execute_mime_renderers)
+    data_priority = config.jupyter_execute_data_priority
+    if not isinstance(data_priority, dict):
+        data_priority = {'default': data_priority}
+    app.jupyter_data_priorities = {
+        key: compile_data_priority(priority, renderers)
+        for key, priority in data_priority.items()
+    }
+    app.jupyter_output_renderers = {
+        mime_type: renderers[mime_type]
+        for table in app.jupyter_data_priorities.values()
+        for mime_type in table
+    }
+
+
+def select_data_priority(app):
+    """Select the precompiled mime type priorities for the current builder."""
+    tables = app.jupyter_data_priorities
+    for key in (app.builder.name, app.builder.format, 'default'):
+        if key in tables:
+            app.jupyter_data_priority = tables[key]
+            return
+    app.jupyter_data_priority = {}
+
+
+def execute_kwargs_fingerprint(config):
+    kwargs = json.dumps(
+        config.jupyter_execute_kwargs, sort_keys=True, default=repr
+    )
+    return hashlib.sha1(kwargs.encode()).hexdigest()
+
+
+def renderers_fingerprint(app):
+    # Renderers are functions, which do not pickle with the environment;
+    # they are identified by their qualified names instead.
+    renderers = json.dumps({
+        mime_type: '{}.{}'.format(
+            getattr(render, '__module__', None),
+            getattr(render, '__qualname__', repr(render)),
+        )
+        for mime_type, render in app.jupyter_output_renderers.items()
+    }, sort_keys=True)
+    return hashlib.sha1(renderers.encode()).hexdigest()
+
+
+def kernel_spec_fingerprint(kernel_name):
+    try:
+        spec = kernel_spec(kernel_name)
+    except ExtensionError:
+        return None
+    spec = json.dumps(
+        [spec.resource_dir, spec.to_dict()], sort_keys=True, default=repr
+    )
+    return hashlib.sha1(spec.encode()).hexdigest()
+
+
+def path_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_outdated_executions(app, env, added, changed, removed):
+    """Return the documents whose execution inputs changed.
+
+    These are documents executed with different 'jupyter_execute_kwargs'
+    or output renderers, with a kernel whose spec changed, or with a kernel
+    that had a site-packages directory on its 'sys.path' modified (by
+    installing or removing a package).
+    """
+    # Some Sphinx versions pass the builder rather than the environment
+    env = app.env
+    inputs = getattr(env, 'jupyter_execution_inputs', {})
+    kwargs = execute_kwargs_fingerprint(app.config)
+    renderers = renderers_fingerprint(app)
+    kernels = {}
+    mtimes = {}
+
+    def outdated(record):
+        if record['kwargs'] != kwargs:
+            return True
+        if record.get('renderers') != renderers:
+            return True
+        for kernel_name, fingerprint in record['kernels'].items():
+            if kernel_name not in kernels:
+                kernels[kernel_name] = kernel_spec_fingerprint(kernel_name)
+            if kernels[kernel_name] != fingerprint:
+                return True
+        for path, mtime in record['paths'].items():
+            if path not in mtimes:
+                mtimes[path] = path_mtime(path)
+            if mtimes[path] != mtime:
+                return True
+        return False
+
+    already_outdated = added | changed | removed
+    return [
+        docname for docname, record in inputs.items()
+        if docname not in already_outdated and outdated(record)
+    ]
+
+
+def init_execution_inputs(app, env, docnames):
+    if not hasattr(env, 'jupyter_execution_inputs'):
+        env.jupyter_execution_inputs = {}
+
+
+def purge_execution_inputs(app, env, docname):
+    getattr(env, 'jupyter_execution_inputs', {}).pop(docname, None)
+
+
+DOWNLOAD_ROLE = re.compile(r':jupyter-download:(notebook|script):`([^`]+)`')
+
+
+def download_key(target):
+    """Return the path relative to the source directory of a download."""
+    return os.path.normpath(target.lstrip('/')).replace(os.sep, '/')
+
+
+def scan_download_targets(env, docnames):
+    """Return the notebooks and scripts that 'docnames' link to."""
+    targets = set()
+    for docname in docnames:
+        try:
+            with open(env.doc2path(docname),
+                      encoding=env.config.source_encoding) as f:
+                source = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        download_dir = sphinx_abs_dir(env, docname)
+        for filetype, name in DOWNLOAD_ROLE.findall(source):
+            ext = '.ipynb' if filetype == 'notebook' else '.py'
+            targets.add(download_key(os.path.join(download_dir, name + ext)))
+    return targets
+
+
+def collect_download_targets(app, env, docnames):
+    """Collect the notebooks and scripts linked to from any document.
+
+    A document may link to the notebook of another one, which must then be
+    written before Sphinx checks the link. Documents that are not read
+    again keep their links in 'env.dlfiles'; the others are scanned for
+    'jupyter-download' roles.
+    """
+    app.jupyter_download_targets = (
+        {download_key(filename) for filename in env.dlfiles}
+        | scan_download_targets(env, docnames)
+    )
+
+
+def get_outdated_downloads(app, env, added, changed, removed):
+    """Return the documents whose unwritten notebooks are now linked to.
+
+    With 'jupyter_execute_lean_notebooks' only the notebooks and scripts
+    that some document links to are written, so a new link to one that
+    was not written requires executing its document again.
+    """
+    # Some Sphinx versions pass the builder rather than the environment
+    env = app.env
+    skipped = getattr(env, 'jupyter_skipped_downloads', {})
+    if not skipped:
+        return []
+    targets = scan_download_targets(env, added | changed)
+    already_outdated = added | changed | removed
+    return [
+        docname for docname, keys in skipped.items()
+        if docname not in already_outdated and keys & targets
+    ]
+
+
+def init_skipped_downloads(app, env, docnames):
+    if not hasattr(env, 'jupyter_skipped_downloads'):
+        env.jupyter_skipped_downloads = {}
+
+
+def purge_skipped_downloads(app, env, docname):
+    getattr(env, 'jupyter_skipped_downloads', {}).pop(docname, None)
+
+
+def flush_output(app, env):
+    app.jupyter_output_writer.flush()
+
+
+def finish_output(app, exception):
+    if exception is None:
+        app.jupyter_output_writer.flush()
+
+
+def init_resource_usage(app, env, docnames):
+    if not hasattr(env, 'jupyter_resource_usage'):
+        env.jupyter_resource_usage = {}
+
+
+def purge_resource_usage(app, env, docname):
+    getattr(env, 'jupyter_resource_usage', {}).pop(docname, None)
+
+
+def write_resource_report(app, exception):
+    """Write the peak resource use of each executed notebook to a report."""
+    usage = getattr(app.env, 'jupyter_resource_usage', None)
+    if exception is not None or not usage:
+        return
+    output_dir = output_directory(app.env)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'resource_usage.json'), 'w') as f:
+        json.dump(usage, f, indent=1, sort_keys=True)
+
 
 def setup(app):
     # Configuration
+    # Changes to this only re-execute the affected documents; see
+    # 'get_outdated_executions'.
     app.add_config_value(
         'jupyter_execute_kwargs',
         dict(timeout=-1, allow_errors=True),
-        'env'
+        ''
     )
     app.add_config_value(
         'jupyter_execute_default_kernel',
         'python3',
         'env'
     )
+    # Either a list of mime types for all builders, or a dict of such lists
+    # keyed by builder name or format (with 'default' for the others).
+    app.add_config_value('jupyter_execute_data_priority', DATA_PRIORITY, 'env')
+    # Extra renderers, mapping mime types to functions as in MIME_RENDERERS.
+    # Changes to this only re-render the affected documents; see
+    # 'get_outdated_executions'.
+    app.add_config_value('jupyter_execute_mime_renderers', {}, '')
+    # Limits on the resources used by each notebook's kernel; these
+    # require 'psutil'. Memory is in bytes, CPU time in seconds.
+    app.add_config_value('jupyter_execute_memory_limit', None, 'env')
+    app.add_config_value('jupyter_execute_cpu_time_limit', None, 'env')
+    # Fail the build when a limit is exceeded, rather than reporting an
+    # error and keeping the outputs up to that point.
+    app.add_config_value('jupyter_execute_fail_on_resource_limit', False, '')
+    # Number of characters of stream output retained per cell and per
+    # notebook; the full streams are written to files next to the notebook.
+    app.add_config_value('jupyter_execute_cell_output_limit', 100000, 'env')
     app.add_config_value(
-        'jupyter_execute_data_priority',
-        [
-            WIDGET_VIEW_MIMETYPE,
-            'text/html',
-            'image/svg+xml',
-            'image/png',
-            'image/jpeg',
-            'text/latex',
-            'text/plain'
-        ],
-        'env',
+        'jupyter_execute_notebook_output_limit', 1000000, 'env'
     )
+    # Run consecutive 'hide-output' cells in a single execute request
+    app.add_config_value('jupyter_execute_batch_cells', False, 'env')
+    # Write compact, unvalidated notebooks, and only write the notebooks and
+    # scripts that some document links to with 'jupyter-download'.
+    app.add_config_value('jupyter_execute_lean_notebooks', False, 'env')
 
     # KernelNode is just a doctree marker for the ExecuteJupyterCells
     # transform, so we don't actually render it.
@@ -496,6 +1982,9 @@ def setup(app):
         man=(skip, None),
     )
 
+    # MimeBundleNode is always replaced by SelectMimeType before writing
+    app.add_node(MimeBundleNode)
+
     app.add_node(
         Cell,
         html=(visit_container, depart_container),
@@ -511,6 +2000,45 @@ def setup(app):
     app.add_role('jupyter-download:script', jupyter_download_role)
     app.add_transform(ExecuteJupyterCells)
 
+    # Kernel specs
+    app.connect('config-inited', init_kernel_specs)
+
+    # Output rendering
+    app.jupyter_mime_renderers = dict(MIME_RENDERERS)
+    app.connect('config-inited', compile_renderers)
+    app.connect('builder-inited', select_data_priority)
+    app.add_post_transform(SelectMimeType)
+
+    # Kernels shared between documents with ':session:'
+    app.jupyter_kernel_sessions = KernelSessions()
+    app.connect('env-get-outdated', get_outdated_sessions)
+    app.connect('env-before-read-docs', init_sessions)
+    app.connect('env-purge-doc', purge_sessions)
+    app.connect('env-updated', rerun_sessions)
+    app.connect('build-finished', shutdown_sessions)
+
+    # Re-execution when the inputs of an execution change
+    app.connect('env-get-outdated', get_outdated_executions)
+    app.connect('env-before-read-docs', init_execution_inputs)
+    app.connect('env-purge-doc', purge_execution_inputs)
+
+    # Kernel resource monitoring
+    app.connect('config-inited', check_resource_limits)
+    app.connect('env-before-read-docs', init_resource_usage)
+    app.connect('env-purge-doc', purge_resource_usage)
+    app.connect('build-finished', write_resource_report)
+
+    # Notebooks, scripts and widget state are written in the background;
+    # connected last so that documents re-read at env-updated are flushed.
+    app.jupyter_output_writer = OutputWriter()
+    app.jupyter_download_targets = set()
+    app.connect('env-get-outdated', get_outdated_downloads)
+    app.connect('env-before-read-docs', init_skipped_downloads)
+    app.connect('env-purge-doc', purge_skipped_downloads)
+    app.connect('env-before-read-docs', collect_download_targets)
+    app.connect('env-updated', flush_output)
+    app.connect('build-finished', finish_output)
+
     # For syntax highlighting
     app.add_lexer('ipythontb', IPythonTracebackLexer())
     app.add_lexer('ipython', IPython3Lexer())
@@ -17,10 +17,15 @@ setup(
     license = 'BSD',
     packages = ['jupyter_sphinx'],
     install_requires = [
-        'Sphinx>=0.6',
+        # jupyter_sphinx.execute uses SphinxPostTransform
+        'Sphinx>=2.0',
         'ipywidgets>=6.0.0',
         'IPython',
-        'nbconvert',
+        # jupyter_sphinx.execute overrides private ExecutePreprocessor methods
+        'nbconvert>=5.4,<6',
         'nbformat',
     ],
+    extras_require = {
+        'monitor': ['psutil'],
+    },
 )